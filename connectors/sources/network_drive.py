@@ -6,13 +6,16 @@
 """Network Drive source module responsible to fetch documents from Network Drive.
 """
 import asyncio
-import os
-from functools import cached_property, partial
-from io import BytesIO
+import binascii
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
 
 import fastjsonschema
 import smbclient
 from smbprotocol.exceptions import SMBException, SMBOSError
+from smbprotocol.file_info import FileAttributes
 from wcmatch import glob
 
 from connectors.filtering.validation import (
@@ -22,22 +25,88 @@ from connectors.filtering.validation import (
 from connectors.source import BaseDataSource
 from connectors.utils import (
     TIKA_SUPPORTED_FILETYPES,
+    ConcurrentTasks,
+    MemQueue,
     RetryStrategy,
-    get_base64_value,
     iso_utc,
     retryable,
 )
 
 MAX_CHUNK_SIZE = 65536
+# base64 encodes 3 bytes at a time, reading multiples of 3 lets every chunk
+# but the last one be encoded on its own
+READ_CHUNK_SIZE = MAX_CHUNK_SIZE - MAX_CHUNK_SIZE % 3
 DEFAULT_FILE_SIZE_LIMIT = 10485760
 RETRIES = 3
 RETRY_INTERVAL = 2
+MAX_CONCURRENCY = 32
+SESSION_POOL_SIZE = 4
+QUEUE_MEM_SIZE = 5 * 1024 * 1024  # Size in bytes
+# extensions without their leading dot, to be matched with str.rpartition
+SUPPORTED_FILETYPES = frozenset(
+    filetype.lstrip(".") for filetype in TIKA_SUPPORTED_FILETYPES
+)
 
 
 class InvalidRulesError(Exception):
     pass
 
 
+def _split_on_first_magic(pattern):
+    """Split a glob pattern into its leading literal folders and the remaining glob
+
+    Args:
+        pattern (str): Glob pattern of an advanced rule, using `/` as separator
+
+    Returns:
+        prefix (str): Folders before the first segment containing glob characters.
+        tail (str): The rest of the pattern, empty if the pattern has no glob characters.
+    """
+    segments = pattern.strip("/").split("/")
+    for index, segment in enumerate(segments):
+        if glob.is_magic(segment, flags=glob.GLOBSTAR):
+            return "/".join(segments[:index]), "/".join(segments[index:])
+    return "/".join(segments), ""
+
+
+def _normalize_path(path):
+    """Strip the server from a path returned by `smbclient.walk`, using `/` as separator
+
+    Args:
+        path (str): Full UNC path of a folder
+    """
+    return path.split("/", 1)[1].replace("\\", "/")
+
+
+def _can_match_below(path, pattern):
+    """Tell whether a folder, or any folder under it, can match a glob pattern
+
+    Args:
+        path (str): Path of the folder without the server, using `/` as separator
+        pattern (str): Glob pattern of an advanced rule, using `/` as separator
+    """
+    pattern_segments = pattern.strip("/").split("/")
+    for index, segment in enumerate(path.split("/")):
+        if index == len(pattern_segments):
+            return False
+        if pattern_segments[index] == "**":
+            return True
+        if not _compile_pattern(pattern_segments[index]).match(segment):
+            return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def _compile_pattern(pattern):
+    """Compile a glob pattern into a regex, once per distinct pattern
+
+    Args:
+        pattern (str): Glob pattern of an advanced rule, using `/` as separator
+    """
+    include, _ = glob.translate(pattern, flags=glob.GLOBSTAR)
+    return re.compile(include[0])
+
+
 class NetworkDriveAdvancedRulesValidator(AdvancedRulesValidator):
     RULES_OBJECT_SCHEMA_DEFINITION = {
         "type": "object",
@@ -55,7 +124,9 @@ class NetworkDriveAdvancedRulesValidator(AdvancedRulesValidator):
         self.source = source
 
     async def validate(self, advanced_rules):
-        if len(advanced_rules) == 0:
+        # an empty array or object is the default value set by Kibana, there is
+        # no need to connect to the drive to validate it
+        if not advanced_rules:
             return SyncRuleValidationResult.valid_result(
                 SyncRuleValidationResult.ADVANCED_RULES
             )
@@ -77,9 +148,9 @@ class NetworkDriveAdvancedRulesValidator(AdvancedRulesValidator):
                 validation_message=e.message,
             )
 
-        self.source.create_connection()
+        await self.source.run_in_executor(self.source.create_connection)
 
-        _, invalid_rules = self.source.find_matching_paths(advanced_rules)
+        _, invalid_rules = await self.source.find_matching_paths(advanced_rules)
 
         if len(invalid_rules) > 0:
             return SyncRuleValidationResult(
@@ -112,7 +183,19 @@ class NASDataSource(BaseDataSource):
         self.server_ip = self.configuration["server_ip"]
         self.port = self.configuration["server_port"]
         self.drive_path = self.configuration["drive_path"]
-        self.session = None
+        self.sessions = []
+        self.directory_details = {}
+
+        # every connection cache holds its own connection to the server, so
+        # that concurrent operations are spread over several sockets
+        self._connection_caches = [{} for _ in range(SESSION_POOL_SIZE)]
+        self._pending_operations = [0] * SESSION_POOL_SIZE
+        # smbclient is blocking, all of its calls run on this executor
+        self._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+        self.tasks = 0
+        self.queue = MemQueue(maxmemsize=QUEUE_MEM_SIZE, refresh_timeout=120)
+        self.fetchers = ConcurrentTasks(max_concurrency=MAX_CONCURRENCY)
 
     def advanced_rules_validators(self):
         return [NetworkDriveAdvancedRulesValidator(self)]
@@ -155,19 +238,103 @@ class NASDataSource(BaseDataSource):
         }
 
     def create_connection(self):
-        """Creates an SMB session to the shared drive."""
-        self.session = smbclient.register_session(
-            server=self.server_ip,
-            username=self.username,
-            password=self.password,
-            port=self.port,
+        """Creates a pool of SMB sessions to the shared drive, each on its own connection."""
+        self.sessions = [
+            smbclient.register_session(
+                server=self.server_ip,
+                username=self.username,
+                password=self.password,
+                port=self.port,
+                connection_cache=connection_cache,
+            )
+            for connection_cache in self._connection_caches
+        ]
+
+    @asynccontextmanager
+    async def _acquire_session(self):
+        """Acquire the session of the pool with the fewest pending operations
+
+        Yields:
+            dict: Connection cache of the session, to pass to `smbclient` calls
+        """
+        index = self._pending_operations.index(min(self._pending_operations))
+        self._pending_operations[index] += 1
+        try:
+            yield self._connection_caches[index]
+        finally:
+            self._pending_operations[index] -= 1
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        """Run a blocking call on the executor of the source, out of the event loop
+
+        Args:
+            func (callable): The blocking function to call
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor=self._executor, func=partial(func, *args, **kwargs)
         )
 
-    @cached_property
-    def get_directory_details(self):
-        return list(smbclient.walk(top=rf"\\{self.server_ip}/{self.drive_path}"))
+    def _get_walk_root(self, glob_pattern):
+        """Get the folder to walk to find the folders matching a glob pattern
 
-    def find_matching_paths(self, advanced_rules):
+        The literal folders leading the pattern are used as the root of the walk,
+        so that the sibling subtrees are never listed.
+
+        Args:
+            glob_pattern (str): Glob pattern of an advanced rule, using `/` as separator
+        """
+        prefix, _ = _split_on_first_magic(glob_pattern)
+        drive_path = (self.drive_path or "").replace("\\", "/").strip("/")
+        if prefix.startswith(f"{drive_path}/"):
+            return rf"\\{self.server_ip}/{prefix}"
+        return rf"\\{self.server_ip}/{self.drive_path}"
+
+    def _filtered_walk(self, top, glob_patterns, connection_cache):
+        """Walk the tree rooted at `top`, skipping the folders no pattern can match
+
+        `smbclient.walk` lists a folder only once it reaches it, so pruning
+        `dirnames` in place saves the listing of the whole pruned subtree.
+
+        Args:
+            top (str): The full UNC path of the folder to walk
+            glob_patterns (frozenset): Glob patterns of the advanced rules, using `/` as separator
+            connection_cache (dict): Connection cache of the session to walk with
+        """
+        for dirpath, dirnames, filenames in smbclient.walk(
+            top=top, connection_cache=connection_cache
+        ):
+            parent = _normalize_path(dirpath)
+            dirnames[:] = [
+                dirname
+                for dirname in dirnames
+                if any(
+                    _can_match_below(f"{parent}/{dirname}", glob_pattern)
+                    for glob_pattern in glob_patterns
+                )
+            ]
+            yield dirpath, dirnames, filenames
+
+    async def walk_directory(self, top, glob_patterns):
+        """Walk the tree rooted at `top` once for all the given patterns
+
+        The result is cached per root, and reused as long as it was pruned for
+        all the patterns asked for.
+
+        Args:
+            top (str): The full UNC path of the folder to walk
+            glob_patterns (frozenset): Glob patterns the walked folders are pruned with
+        """
+        cached_patterns, folders = self.directory_details.get(top, (frozenset(), None))
+        if folders is None or not glob_patterns <= cached_patterns:
+            async with self._acquire_session() as connection_cache:
+                folders = await self.run_in_executor(
+                    list, self._filtered_walk(top, glob_patterns, connection_cache)
+                )
+            self.directory_details[top] = (glob_patterns, folders)
+        return folders
+
+    async def find_matching_paths(self, advanced_rules):
         """
         Find matching paths based on advanced rules.
 
@@ -180,16 +347,38 @@ class NASDataSource(BaseDataSource):
         """
         invalid_rules = []
         matched_paths = set()
-        for rule in advanced_rules:
-            rule_valid = False
-            glob_pattern = rule["pattern"].replace("\\", "/")
-            for path, _, _ in self.get_directory_details:
-                normalized_path = path.split("/", 1)[1].replace("\\", "/")
-                is_match = glob.globmatch(
-                    normalized_path, glob_pattern, flags=glob.GLOBSTAR
-                )
+        glob_patterns = [rule["pattern"].replace("\\", "/") for rule in advanced_rules]
 
-                if is_match:
+        # a root inside another root is covered by the walk of the latter, so only
+        # the topmost roots are walked, once for all the patterns under them
+        roots = {
+            glob_pattern: self._get_walk_root(glob_pattern)
+            for glob_pattern in glob_patterns
+        }
+        walk_roots = {
+            glob_pattern: min(
+                (
+                    other
+                    for other in roots.values()
+                    if root == other or root.startswith(f"{other}/")
+                ),
+                key=len,
+            )
+            for glob_pattern, root in roots.items()
+        }
+        patterns_by_root = {}
+        for glob_pattern, root in walk_roots.items():
+            patterns_by_root.setdefault(root, set()).add(glob_pattern)
+        folders_by_root = {
+            root: await self.walk_directory(root, frozenset(patterns))
+            for root, patterns in patterns_by_root.items()
+        }
+
+        for rule, glob_pattern in zip(advanced_rules, glob_patterns, strict=True):
+            rule_valid = False
+            compiled_pattern = _compile_pattern(glob_pattern)
+            for path, _, _ in folders_by_root[walk_roots[glob_pattern]]:
+                if compiled_pattern.match(_normalize_path(path)):
                     rule_valid = True
                     matched_paths.add(path)
             if not rule_valid:
@@ -198,73 +387,118 @@ class NASDataSource(BaseDataSource):
 
     async def ping(self):
         """Verify the connection with Network Drive"""
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(executor=None, func=self.create_connection)
+        await self.run_in_executor(self.create_connection)
         self._logger.info("Successfully connected to the Network Drive")
 
     async def close(self):
         """Close all the open smb sessions"""
-        if self.session is None:
-            return
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            executor=None,
-            func=partial(
-                smbclient.delete_session, server=self.server_ip, port=self.port
-            ),
+        self.fetchers.cancel()
+        # caches are checked rather than `self.sessions`, which is not set when
+        # the pool was only partly registered
+        for connection_cache in self._connection_caches:
+            if connection_cache:
+                await self.run_in_executor(
+                    smbclient.delete_session,
+                    server=self.server_ip,
+                    port=self.port,
+                    connection_cache=connection_cache,
+                )
+        self.sessions = []
+        self._executor.shutdown(wait=False)
+
+    async def _scandir(self, path):
+        """List the entries of the folder on given path
+
+        The session is released before the entries are consumed, so that a slow
+        consumer doesn't keep it busy.
+
+        Args:
+            path (str): The path of a folder in the Network Drive
+
+        Returns:
+            list: Entries of the folder, empty if it can't be listed
+        """
+        async with self._acquire_session() as connection_cache:
+            try:
+                # scandir is lazy, the listing happens while iterating on it
+                return await self.run_in_executor(
+                    lambda: list(
+                        smbclient.scandir(path, connection_cache=connection_cache)
+                    )
+                )
+            except (SMBOSError, SMBException) as exception:
+                self._logger.exception(
+                    f"Error while scanning the path {path}. Error {exception}"
+                )
+                return []
+
+    def _format_entry(self, file):
+        """Format an entry returned by `smbclient.scandir` as a document
+
+        Args:
+            file (smbclient.SMBDirEntry): Entry of a folder in the Network Drive
+        """
+        file_details = file._dir_info.fields
+        is_folder = (
+            file_details["file_attributes"].get_value()
+            & FileAttributes.FILE_ATTRIBUTE_DIRECTORY
         )
+        return {
+            "path": file.path,
+            "size": file_details["allocation_size"].get_value(),
+            "_id": file_details["file_id"].get_value(),
+            "created_at": iso_utc(file_details["creation_time"].get_value()),
+            "_timestamp": iso_utc(file_details["change_time"].get_value()),
+            "type": "folder" if is_folder else "file",
+            "title": file.name,
+        }
 
     async def get_files(self, path):
         """Fetches the metadata of the files and folders present on given path
 
+        The directory query issued by `smbclient.scandir` already returns the id,
+        size, timestamps and attributes of every entry, so no extra round trip is
+        made per entry.
+
         Args:
             path (str): The path of a folder in the Network Drive
         """
-        files = []
-        loop = asyncio.get_running_loop()
-        try:
-            files = await loop.run_in_executor(None, smbclient.scandir, path)
-        except (SMBOSError, SMBException) as exception:
-            self._logger.exception(
-                f"Error while scanning the path {path}. Error {exception}"
-            )
+        for file in await self._scandir(path):
+            yield self._format_entry(file)
 
-        for file in files:
-            file_details = file._dir_info.fields
-            yield {
-                "path": file.path,
-                "size": file_details["allocation_size"].get_value(),
-                "_id": file_details["file_id"].get_value(),
-                "created_at": iso_utc(file_details["creation_time"].get_value()),
-                "_timestamp": iso_utc(file_details["change_time"].get_value()),
-                "type": "folder" if file.is_dir() else "file",
-                "title": file.name,
-            }
-
-    def fetch_file_content(self, path):
-        """Fetches the file content from the given drive path
+    async def fetch_file_content(self, path):
+        """Fetches the file content from the given drive path in chunks
 
         Args:
             path (str): The file path of the file on the Network Drive
+
+        Yields:
+            bytes: Chunk of at most `READ_CHUNK_SIZE` bytes of the file content
+
+        Raises:
+            SMBOSError: The file can't be opened or a read fails midway.
         """
-        try:
-            with smbclient.open_file(
-                path=path, encoding="utf-8", errors="ignore", mode="rb"
-            ) as file:
-                file_content, chunk = BytesIO(), True
-                while chunk:
-                    chunk = file.read(MAX_CHUNK_SIZE) or b""
-                    file_content.write(chunk)
-                file_content.seek(0)
-                return file_content
-        except SMBOSError as error:
-            self._logger.error(
-                f"Cannot read the contents of file on path:{path}. Error {error}"
+        async with self._acquire_session() as connection_cache:
+            file = await self.run_in_executor(
+                smbclient.open_file,
+                path=path,
+                encoding="utf-8",
+                errors="ignore",
+                mode="rb",
+                connection_cache=connection_cache,
             )
+            try:
+                while chunk := await self.run_in_executor(file.read, READ_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                await self.run_in_executor(file.close)
 
     async def get_content(self, file, timestamp=None, doit=None):
         """Get the content for a given file
 
+        The content is base64 encoded chunk by chunk while it is read, so the raw
+        file content is never held in memory as a whole.
+
         Args:
             file (dictionary): Formatted file document
             timestamp (timestamp, optional): Timestamp of file last modified. Defaults to None.
@@ -273,12 +507,11 @@ class NASDataSource(BaseDataSource):
         Returns:
             dictionary: Content document with id, timestamp & text
         """
-        if not (
-            doit
-            and (os.path.splitext(file["title"])[-1]).lower()
-            in TIKA_SUPPORTED_FILETYPES
-            and file["size"]
-        ):
+        if not doit:
+            return
+
+        name, _, extension = file["title"].rpartition(".")
+        if not (name and extension.lower() in SUPPORTED_FILETYPES and file["size"]):
             return
 
         if int(file["size"]) > DEFAULT_FILE_SIZE_LIMIT:
@@ -287,38 +520,159 @@ class NASDataSource(BaseDataSource):
             )
             return
 
-        loop = asyncio.get_running_loop()
-        content = await loop.run_in_executor(
-            executor=None, func=partial(self.fetch_file_content, path=file["path"])
-        )
+        attachment, remainder = [], b""
+        try:
+            async for chunk in self.fetch_file_content(path=file["path"]):
+                # base64 encodes 3 bytes at a time, so only aligned blocks can be
+                # encoded separately and concatenated
+                if remainder:
+                    chunk = remainder + chunk
+                aligned_size = len(chunk) - len(chunk) % 3
+                view = memoryview(chunk)
+                attachment.append(
+                    binascii.b2a_base64(view[:aligned_size], newline=False).decode(
+                        "ascii"
+                    )
+                )
+                remainder = bytes(view[aligned_size:])
+        except (SMBOSError, SMBException) as error:
+            # a partial attachment would be indexed as if it was the whole file
+            self._logger.error(
+                f"Cannot read the contents of file on path:{file['path']}. Error {error}"
+            )
+            return
+        attachment.append(binascii.b2a_base64(remainder, newline=False).decode("ascii"))
 
-        attachment = content.read()
-        content.close()
         return {
             "_id": file["id"],
             "_timestamp": file["_timestamp"],
-            "_attachment": get_base64_value(content=attachment),
+            "_attachment": "".join(attachment),
         }
 
+    async def _list_folder(self, path, folders, recursive):
+        """Put the files and folders present on given path in a queue
+
+        Args:
+            path (str): The path of a folder in the Network Drive
+            folders (asyncio.Queue): Queue of the folders left to list
+            recursive (bool): Whether the sub folders are queued to be listed too
+        """
+        for entry in await self._scandir(path):
+            file = self._format_entry(entry)
+            if file["type"] == "folder":
+                # like smbclient.walk, links are not followed, as they can point
+                # back to a parent folder or to a folder listed elsewhere
+                is_link = (
+                    entry._dir_info.fields["file_attributes"].get_value()
+                    & FileAttributes.FILE_ATTRIBUTE_REPARSE_POINT
+                )
+                if recursive and not is_link:
+                    folders.put_nowait(file["path"])
+                await self.queue.put((file, None))  # pyright: ignore
+            else:
+                await self.queue.put(
+                    (file, partial(self.get_content, file))  # pyright: ignore
+                )
+
+    async def _folder_worker(self, folders, recursive, errors):
+        """List the folders of the queue until a `None` is taken from it
+
+        Args:
+            folders (asyncio.Queue): Queue of the folders left to list
+            recursive (bool): Whether the sub folders are queued to be listed too
+            errors (list): Collects the errors raised while listing the folders
+        """
+        while (path := await folders.get()) is not None:
+            try:
+                # the sync fails on the first error, the other folders are skipped
+                if not errors:
+                    await self._list_folder(path, folders, recursive)
+            except Exception as exception:
+                errors.append(exception)
+            finally:
+                folders.task_done()
+
+    async def _list_folders(self, paths, recursive):
+        """List the given folders on `MAX_CONCURRENCY` workers
+
+        When `recursive` is set, the workers queue the sub folders they find, so
+        every folder of the tree is listed once, while other listings are in flight.
+
+        Args:
+            paths (iterable): Paths of the folders in the Network Drive
+            recursive (bool): Whether the sub folders are listed too
+
+        Raises:
+            Exception: The first error raised while listing a folder. SMB errors
+                are logged by `get_files` instead, as the folder can be skipped.
+        """
+        folders = asyncio.Queue()
+        errors = []
+        try:
+            for path in paths:
+                folders.put_nowait(path)
+            for _ in range(MAX_CONCURRENCY):
+                await self.fetchers.put(
+                    partial(self._folder_worker, folders, recursive, errors)
+                )
+            await folders.join()
+        finally:
+            for _ in range(MAX_CONCURRENCY):
+                folders.put_nowait(None)
+        await self.queue.put("FINISHED")  # pyright: ignore
+        if errors:
+            raise errors[0]
+
+    async def _consumer(self):
+        """Async generator to process entries of the queue
+
+        Yields:
+            dictionary: Documents from Network Drive.
+        """
+        while self.tasks > 0:
+            _, item = await self.queue.get()
+            if item == "FINISHED":
+                self.tasks -= 1
+            else:
+                yield item
+
     async def get_docs(self, filtering=None):
         """Executes the logic to fetch files and folders in async manner.
+
+        Up to `MAX_CONCURRENCY` folders are listed at the same time, since each
+        listing mostly waits on SMB round trips. Without advanced rules, the tree
+        is discovered from these listings, so no folder is listed twice.
+
         Yields:
             dictionary: Dictionary containing the Network Drive files and folders as documents
         """
 
         if filtering and filtering.has_advanced_rules():
             advanced_rules = filtering.get_advanced_rules()
-            matched_paths, invalid_rules = self.find_matching_paths(advanced_rules)
+            paths, invalid_rules = await self.find_matching_paths(advanced_rules)
             if len(invalid_rules) > 0:
                 raise InvalidRulesError(
                     f"Following advanced rules are invalid: {invalid_rules}"
                 )
+            recursive = False
         else:
-            matched_paths = (path for path, _, _ in self.get_directory_details)
-
-        for path in matched_paths:
-            async for file in self.get_files(path=path):
-                if file["type"] == "folder":
-                    yield file, None
-                else:
-                    yield file, partial(self.get_content, file)
+            paths = [rf"\\{self.server_ip}/{self.drive_path}"]
+            recursive = True
+
+        # the consumer stops once the producer has listed every folder
+        self.tasks += 1
+        producer = asyncio.create_task(self._list_folders(paths, recursive))
+        try:
+            async for item in self._consumer():
+                yield item
+
+            await producer
+            await self.fetchers.join()
+        finally:
+            # stops the listings left when the sync ends early or is cancelled,
+            # and drops what they queued, so the next sync starts afresh
+            producer.cancel()
+            self.fetchers.cancel()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.tasks = 0
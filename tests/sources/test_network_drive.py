@@ -7,403 +7,755 @@
 """
 import asyncio
 import datetime
-from io import BytesIO
+from types import SimpleNamespace
 from unittest import mock
 from unittest.mock import ANY
 
 import pytest
+import pytest_asyncio
 import smbclient
 from smbprotocol.exceptions import LogonFailure, SMBOSError
+from smbprotocol.file_info import FileAttributes
 
 from connectors.filtering.validation import SyncRuleValidationResult
 from connectors.protocol import Filter
 from connectors.sources.network_drive import (
+    READ_CHUNK_SIZE,
+    SESSION_POOL_SIZE,
     NASDataSource,
     NetworkDriveAdvancedRulesValidator,
+    _can_match_below,
+    _compile_pattern,
+    _split_on_first_magic,
 )
 from tests.commons import AsyncIterator
 from tests.sources.support import create_source
 
-READ_COUNT = 0
-MAX_CHUNK_SIZE = 65536
 ADVANCED_SNIPPET = "advanced_snippet"
+MOCK_PATH = "\\1.2.3.4/dummy_path"
+CREATION_FILE = datetime.datetime(2022, 1, 11, 12, 12, 30)
+CHANGE_FILE = datetime.datetime(2022, 4, 21, 12, 12, 30)
+CREATION_FOLDER = datetime.datetime(2022, 2, 11, 12, 12, 30)
+CHANGE_FOLDER = datetime.datetime(2022, 5, 21, 12, 12, 30)
+
+# (dirpath, dirnames, filenames), as yielded by smbclient.walk
+MOCK_WALK_DATA = (
+    ("\\\\1.2.3.4/a", ("b",), ("d.txt",)),
+    ("\\\\1.2.3.4/a/b", ("e",), ("c.txt",)),
+    ("\\\\1.2.3.4/a/b/e", (), ()),
+)
+TRAINING_WALK_DATA = (
+    ("\\\\1.2.3.4/training", ("java", "python"), ("d.txt", "a.txt")),
+    ("\\\\1.2.3.4/training/python", ("basics", "async"), ("c.txt",)),
+    ("\\\\1.2.3.4/training/python/async", (), ("coroutines.py",)),
+    ("\\\\1.2.3.4/training/python/basics", ("examples",), ()),
+    ("\\\\1.2.3.4/training/python/basics/examples", (), ("lecture.py",)),
+    (
+        "\\\\1.2.3.4/training/java",
+        (),
+        ("hello.java", "inheritance.java", "collections.java"),
+    ),
+)
+
 
+def mock_field(value):
+    """Generates a smbprotocol field whose `get_value` returns the given value
 
-def mock_file(name):
+    Args:
+        value: The value of the mocked field
+    """
+    return SimpleNamespace(get_value=lambda: value)
+
+
+def mock_file(name, folder=MOCK_PATH):
     """Generates the smbprotocol object for a file
 
     Args:
         name (str): The name of the mocked file
+        folder (str): The path of the folder of the mocked file
     """
-    mock_response = mock.Mock()
-    mock_response.name = name
-    mock_response.path = f"\\1.2.3.4/dummy_path/{name}"
-    mock_stats = {}
-    mock_stats["file_id"] = mock.Mock()
-    mock_stats["file_id"].get_value.return_value = "1"
-    mock_stats["allocation_size"] = mock.Mock()
-    mock_stats["allocation_size"].get_value.return_value = "30"
-    mock_stats["creation_time"] = mock.Mock()
-    mock_stats["creation_time"].get_value.return_value = datetime.datetime(
-        2022, 1, 11, 12, 12, 30
-    )
-    mock_stats["change_time"] = mock.Mock()
-    mock_stats["change_time"].get_value.return_value = datetime.datetime(
-        2022, 4, 21, 12, 12, 30
+    return SimpleNamespace(
+        name=name,
+        path=f"{folder}/{name}",
+        _dir_info=SimpleNamespace(
+            fields={
+                "file_id": mock_field("1"),
+                "allocation_size": mock_field("30"),
+                "creation_time": mock_field(CREATION_FILE),
+                "change_time": mock_field(CHANGE_FILE),
+                "file_attributes": mock_field(FileAttributes.FILE_ATTRIBUTE_ARCHIVE),
+            }
+        ),
     )
 
-    mock_response._dir_info.fields = mock_stats
-    mock_response.is_dir.return_value = False
-
-    return mock_response
 
-
-def mock_folder(name):
+def mock_folder(
+    name, folder=MOCK_PATH, file_attributes=FileAttributes.FILE_ATTRIBUTE_DIRECTORY
+):
     """Generates the smbprotocol object for a folder
 
     Args:
         name (str): The name of the mocked folder
+        folder (str): The path of the parent folder of the mocked folder
+        file_attributes (int): The attributes of the mocked folder
     """
-    mock_response = mock.Mock()
-    mock_response.name = name
-    mock_response.path = f"\\1.2.3.4/dummy_path/{name}"
-    mock_response.is_dir.return_value = True
-    mock_stats = {}
-    mock_stats["file_id"] = mock.Mock()
-    mock_stats["file_id"].get_value.return_value = "122"
-    mock_stats["allocation_size"] = mock.Mock()
-    mock_stats["allocation_size"].get_value.return_value = "200"
-    mock_stats["creation_time"] = mock.Mock()
-    mock_stats["creation_time"].get_value.return_value = datetime.datetime(
-        2022, 2, 11, 12, 12, 30
-    )
-    mock_stats["change_time"] = mock.Mock()
-    mock_stats["change_time"].get_value.return_value = datetime.datetime(
-        2022, 5, 21, 12, 12, 30
+    return SimpleNamespace(
+        name=name,
+        path=f"{folder}/{name}",
+        _dir_info=SimpleNamespace(
+            fields={
+                "file_id": mock_field("122"),
+                "allocation_size": mock_field("200"),
+                "creation_time": mock_field(CREATION_FOLDER),
+                "change_time": mock_field(CHANGE_FOLDER),
+                "file_attributes": mock_field(file_attributes),
+            }
+        ),
     )
-    mock_response._dir_info.fields = mock_stats
-    return mock_response
 
 
-def side_effect_function(MAX_CHUNK_SIZE):
-    """Dynamically changing return values during reading a file in chunks
+def mock_walk(walk_data, listed_folders=None):
+    """Generates a fake smbclient.walk over the given tree
+
+    Like smbclient.walk, a folder is only listed if the caller left it in the
+    `dirnames` of its parent, and a walk from an unknown `top` yields nothing.
+
     Args:
-        MAX_CHUNK_SIZE: Maximum bytes allowed to be read at a given time
+        walk_data (tuple): The (dirpath, dirnames, filenames) of every folder
+        listed_folders (list): Collects the path of every listed folder
     """
-    global READ_COUNT
-    if READ_COUNT:
-        return None
-    READ_COUNT += 1
-    return b"Mock...."
+    tree = {
+        dirpath: (dirnames, filenames) for dirpath, dirnames, filenames in walk_data
+    }
+
+    def walk(top, **kwargs):
+        if top not in tree:
+            return
+        if listed_folders is not None:
+            listed_folders.append(top)
+        dirnames, filenames = list(tree[top][0]), list(tree[top][1])
+        yield top, dirnames, filenames
+        for dirname in dirnames:
+            yield from walk(f"{top}/{dirname}")
+
+    return walk
+
+
+@pytest_asyncio.fixture(scope="module")
+async def nas_source():
+    """Network Drive source shared by the tests of the module"""
+    async with create_source(NASDataSource) as source:
+        yield source
+
+
+@pytest.fixture(autouse=True)
+def reset_nas_source(nas_source):
+    """Restores the attributes of the shared source after each test"""
+    attributes = dict(vars(nas_source))
+    yield
+    vars(nas_source).clear()
+    vars(nas_source).update(attributes)
+    nas_source.directory_details.clear()
 
 
 @pytest.mark.asyncio
-async def test_ping_for_successful_connection():
+async def test_ping_for_successful_connection(nas_source):
     """Tests the ping functionality for ensuring connection to the Network Drive."""
-    # Setup
-    expected_response = True
-    response = asyncio.Future()
-    response.set_result(expected_response)
-
     # Execute
-    with mock.patch.object(smbclient, "register_session", return_value=response):
-        async with create_source(NASDataSource) as source:
-            await source.ping()
+    with mock.patch.object(
+        smbclient, "register_session", return_value=True
+    ) as session_mock:
+        await nas_source.ping()
+
+    # Assert
+    assert session_mock.call_count == SESSION_POOL_SIZE
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.register_session")
-async def test_ping_for_failed_connection(session_mock):
+async def test_ping_for_failed_connection(session_mock, nas_source):
     """Tests the ping functionality when connection can not be established to Network Drive.
 
     Args:
         session_mock (patch): The patch of register_session method
     """
     # Setup
-    response = asyncio.Future()
-    response.set_result(None)
     session_mock.side_effect = ValueError
-    async with create_source(NASDataSource) as source:
-        # Execute
-        with pytest.raises(Exception):
-            await source.ping()
+    # Execute
+    with pytest.raises(Exception):
+        await nas_source.ping()
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.register_session")
-async def test_create_connection_with_invalid_credentials(session_mock):
+async def test_create_connection_with_invalid_credentials(session_mock, nas_source):
     """Tests the create_connection fails with invalid credentials
 
     Args:
         session_mock (patch): The patch of register_session method
     """
     # Setup
-    async with create_source(NASDataSource) as source:
-        session_mock.side_effect = LogonFailure
+    session_mock.side_effect = LogonFailure
 
-        # Execute
-        with pytest.raises(LogonFailure):
-            source.create_connection()
+    # Execute
+    with pytest.raises(LogonFailure):
+        nas_source.create_connection()
 
 
 @mock.patch("smbclient.scandir")
 @pytest.mark.asyncio
-async def test_get_files_with_invalid_path(dir_mock):
+async def test_get_files_with_invalid_path(dir_mock, nas_source):
     """Tests the scandir method of smbclient throws error on invalid path
 
     Args:
         dir_mock (patch): The patch of scandir method
     """
     # Setup
-    async with create_source(NASDataSource) as source:
-        path = "unknown_path"
-        dir_mock.side_effect = SMBOSError(ntstatus=3221225487, filename="unknown_path")
+    path = "unknown_path"
+    dir_mock.side_effect = SMBOSError(ntstatus=3221225487, filename="unknown_path")
 
-        # Execute
-        async for file in source.get_files(path=path):
-            assert file == []
+    # Execute
+    async for file in nas_source.get_files(path=path):
+        assert file == []
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.scandir")
-async def test_get_files(dir_mock):
+async def test_get_files(dir_mock, nas_source):
     """Tests the get_files method for network drive
 
     Args:
         dir_mock (patch): The patch of scandir method
     """
     # Setup
-    async with create_source(NASDataSource) as source:
-        path = "\\1.2.3.4/dummy_path"
-        dir_mock.return_value = [mock_file(name="a1.md"), mock_folder(name="A")]
-        expected_output = [
-            {
-                "_id": "1",
-                "_timestamp": "2022-04-21T12:12:30",
-                "path": "\\1.2.3.4/dummy_path/a1.md",
-                "title": "a1.md",
-                "created_at": "2022-01-11T12:12:30",
-                "size": "30",
-                "type": "file",
-            },
-            {
-                "_id": "122",
-                "_timestamp": "2022-05-21T12:12:30",
-                "path": "\\1.2.3.4/dummy_path/A",
-                "title": "A",
-                "created_at": "2022-02-11T12:12:30",
-                "size": "200",
-                "type": "folder",
-            },
-        ]
+    path = MOCK_PATH
+    dir_mock.return_value = [mock_file(name="a1.md"), mock_folder(name="A")]
+    expected_output = [
+        {
+            "_id": "1",
+            "_timestamp": "2022-04-21T12:12:30",
+            "path": "\\1.2.3.4/dummy_path/a1.md",
+            "title": "a1.md",
+            "created_at": "2022-01-11T12:12:30",
+            "size": "30",
+            "type": "file",
+        },
+        {
+            "_id": "122",
+            "_timestamp": "2022-05-21T12:12:30",
+            "path": "\\1.2.3.4/dummy_path/A",
+            "title": "A",
+            "created_at": "2022-02-11T12:12:30",
+            "size": "200",
+            "type": "folder",
+        },
+    ]
 
-        # Execute
-        response = []
-        async for file in source.get_files(path=path):
-            response.append(file)
+    # Execute
+    response = [file async for file in nas_source.get_files(path=path)]
+
+    # Assert
+    assert response == expected_output
+
+
+@pytest.mark.asyncio
+@mock.patch("smbclient.scandir")
+async def test_get_files_keeps_sub_second_timestamps(dir_mock, nas_source):
+    """Tests the get_files method keeps the precision of the SMB timestamps
+
+    Args:
+        dir_mock (patch): The patch of scandir method
+    """
+    # Setup
+    file = mock_file(name="a1.md")
+    file._dir_info.fields["change_time"] = mock_field(
+        datetime.datetime(2022, 4, 21, 12, 12, 30, 123456)
+    )
+    dir_mock.return_value = [file]
 
+    # Execute
+    response = [document async for document in nas_source.get_files(path=MOCK_PATH)]
+
+    # Assert
+    assert response[0]["_timestamp"] == "2022-04-21T12:12:30.123456"
+
+
+@pytest.mark.asyncio
+@mock.patch("smbclient.scandir")
+async def test_get_files_releases_session_before_yielding(dir_mock, nas_source):
+    """Tests get_files doesn't hold a session while its entries are consumed
+
+    Args:
+        dir_mock (patch): The patch of scandir method
+    """
+    # Setup
+    dir_mock.return_value = [mock_file(name="a1.md")]
+
+    # Execute
+    async for _ in nas_source.get_files(path=MOCK_PATH):
         # Assert
-        assert response == expected_output
+        assert nas_source._pending_operations == [0] * SESSION_POOL_SIZE
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.open_file")
-async def test_fetch_file_when_file_is_inaccessible(file_mock):
+async def test_fetch_file_when_file_is_inaccessible(file_mock, nas_source):
     """Tests the open_file method of smbclient throws error when file cannot be accessed
 
     Args:
         file_mock (patch): The patch of open_file method
     """
     # Setup
-    async with create_source(NASDataSource) as source:
-        path = "\\1.2.3.4/Users/file1.txt"
-        file_mock.side_effect = SMBOSError(ntstatus=0xC0000043, filename="file1.txt")
-
-        # Execute
-        response = source.fetch_file_content(path=path)
+    path = "\\1.2.3.4/Users/file1.txt"
+    file_mock.side_effect = SMBOSError(ntstatus=0xC0000043, filename="file1.txt")
 
-        # Assert
-        assert response is None
+    # Execute and Assert
+    with pytest.raises(SMBOSError):
+        [chunk async for chunk in nas_source.fetch_file_content(path=path)]
+    file_mock.return_value.close.assert_not_called()
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.open_file")
-async def test_get_content(file_mock):
+async def test_get_content(file_mock, nas_source):
     """Test get_content method of Network Drive
 
     Args:
         file_mock (patch): The patch of open_file method
     """
     # Setup
-    async with create_source(NASDataSource) as source:
-        file_mock.return_value.__enter__.return_value.read.return_value = bytes(
-            "Mock....", "utf-8"
-        )
+    file_mock.return_value.read.side_effect = [b"Mock....", b""]
+
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.txt",
+        "path": "\\1.2.3.4/Users/folder1/file1.txt",
+        "size": "50",
+    }
+
+    expected_output = {
+        "_id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "_attachment": "TW9jay4uLi4=",
+    }
 
-        mock_response = {
-            "id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "title": "file1.txt",
-            "path": "\\1.2.3.4/Users/folder1/file1.txt",
-            "size": "50",
-        }
+    # Execute
+    actual_response = await nas_source.get_content(mock_response, doit=True)
 
-        mocked_content_response = BytesIO(b"Mock....")
+    # Assert
+    assert actual_response == expected_output
+    file_mock.return_value.close.assert_called_once()
 
-        expected_output = {
-            "_id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "_attachment": "TW9jay4uLi4=",
-        }
 
-        # Execute
-        source.fetch_file_content = mock.MagicMock(return_value=mocked_content_response)
-        actual_response = await source.get_content(mock_response, doit=True)
+@pytest.mark.asyncio
+@mock.patch("smbclient.open_file")
+async def test_get_content_when_file_is_inaccessible(file_mock, nas_source):
+    """Test get_content returns no attachment when the file can't be opened
 
-        # Assert
-        assert actual_response == expected_output
+    Args:
+        file_mock (patch): The patch of open_file method
+    """
+    # Setup
+    file_mock.side_effect = SMBOSError(ntstatus=0xC0000043, filename="file1.txt")
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.txt",
+        "path": "\\1.2.3.4/Users/folder1/file1.txt",
+        "size": "50",
+    }
+
+    # Execute
+    actual_response = await nas_source.get_content(mock_response, doit=True)
+
+    # Assert
+    assert actual_response is None
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.open_file")
-async def test_get_content_with_upper_extension(file_mock):
-    """Test get_content method of Network Drive
+async def test_get_content_when_read_fails_midway(file_mock, nas_source):
+    """Test get_content returns no partial attachment when a read fails
 
     Args:
         file_mock (patch): The patch of open_file method
     """
     # Setup
-    async with create_source(NASDataSource) as source:
-        file_mock.return_value.__enter__.return_value.read.return_value = bytes(
-            "Mock....", "utf-8"
-        )
+    file_mock.return_value.read = mock.MagicMock(
+        side_effect=[b"abc", SMBOSError(ntstatus=0xC000020C, filename="file1.txt")]
+    )
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.txt",
+        "path": "\\1.2.3.4/Users/folder1/file1.txt",
+        "size": "50",
+    }
 
-        mock_response = {
-            "id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "title": "file1.TXT",
-            "path": "\\1.2.3.4/Users/folder1/file1.txt",
-            "size": "50",
-        }
+    # Execute
+    actual_response = await nas_source.get_content(mock_response, doit=True)
 
-        mocked_content_response = BytesIO(b"Mock....")
+    # Assert
+    assert actual_response is None
+    file_mock.return_value.close.assert_called_once()
 
-        expected_output = {
-            "_id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "_attachment": "TW9jay4uLi4=",
-        }
 
-        # Execute
-        source.fetch_file_content = mock.MagicMock(return_value=mocked_content_response)
-        actual_response = await source.get_content(mock_response, doit=True)
+@pytest.mark.asyncio
+async def test_get_content_with_unaligned_chunks(nas_source):
+    """Test get_content encodes chunks that are not aligned on 3 bytes"""
+    # Setup
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.txt",
+        "path": "\\1.2.3.4/Users/folder1/file1.txt",
+        "size": "50",
+    }
 
-        # Assert
-        assert actual_response == expected_output
+    # Execute
+    nas_source.fetch_file_content = AsyncIterator([b"Mo", b"ck..", b".."])
+    actual_response = await nas_source.get_content(mock_response, doit=True)
+
+    # Assert
+    assert actual_response["_attachment"] == "TW9jay4uLi4="
 
 
 @pytest.mark.asyncio
-async def test_get_content_when_doit_false():
+@mock.patch("smbclient.open_file")
+async def test_get_content_with_upper_extension(file_mock, nas_source):
+    """Test get_content method of Network Drive
+
+    Args:
+        file_mock (patch): The patch of open_file method
+    """
+    # Setup
+    file_mock.return_value.read.side_effect = [b"Mock....", b""]
+
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.TXT",
+        "path": "\\1.2.3.4/Users/folder1/file1.txt",
+        "size": "50",
+    }
+
+    expected_output = {
+        "_id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "_attachment": "TW9jay4uLi4=",
+    }
+
+    # Execute
+    actual_response = await nas_source.get_content(mock_response, doit=True)
+
+    # Assert
+    assert actual_response == expected_output
+    file_mock.return_value.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_get_content_when_doit_false(nas_source):
     """Test get_content method when doit is false."""
     # Setup
-    async with create_source(NASDataSource) as source:
-        mock_response = {
-            "id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "title": "file1.txt",
-        }
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.txt",
+    }
 
-        # Execute
-        actual_response = await source.get_content(mock_response)
+    # Execute
+    actual_response = await nas_source.get_content(mock_response)
 
-        # Assert
-        assert actual_response is None
+    # Assert
+    assert actual_response is None
 
 
 @pytest.mark.asyncio
-async def test_get_content_when_file_size_is_large():
-    """Test the module responsible for fetching the content of the file if it is not extractable"""
+@mock.patch("smbclient.open_file")
+async def test_get_content_when_file_size_is_large(file_mock, nas_source):
+    """Test the module responsible for fetching the content of the file if it is not extractable
+
+    Args:
+        file_mock (patch): The patch of open_file method
+    """
     # Setup
-    async with create_source(NASDataSource) as source:
-        mock_response = {
-            "id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "title": "file1.txt",
-            "size": "20000000000",
-        }
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": "file1.txt",
+        "path": "\\1.2.3.4/Users/folder1/file1.txt",
+        "size": "20000000000",
+    }
 
-        # Execute
-        actual_response = await source.get_content(mock_response, doit=True)
+    # Execute
+    actual_response = await nas_source.get_content(mock_response, doit=True)
 
-        # Assert
-        assert actual_response is None
+    # Assert
+    assert actual_response is None
+    file_mock.assert_not_called()
 
 
+@pytest.mark.parametrize("title", ["file2.dmg", "txt", ".txt"])
 @pytest.mark.asyncio
-async def test_get_content_when_file_type_not_supported():
-    """Test get_content method when the file content type is not supported"""
+async def test_get_content_when_file_type_not_supported(title, nas_source):
+    """Test get_content method when the file content type is not supported
+
+    Args:
+        title (str): Title of a file without a supported extension
+    """
     # Setup
-    async with create_source(NASDataSource) as source:
-        mock_response = {
-            "id": "1",
-            "_timestamp": "2022-04-21T12:12:30",
-            "title": "file2.dmg",
-        }
+    mock_response = {
+        "id": "1",
+        "_timestamp": "2022-04-21T12:12:30",
+        "title": title,
+    }
 
-        # Execute
-        actual_response = await source.get_content(mock_response, doit=True)
+    # Execute
+    actual_response = await nas_source.get_content(mock_response, doit=True)
 
-        # Assert
-        assert actual_response is None
+    # Assert
+    assert actual_response is None
 
 
 @pytest.mark.asyncio
-@mock.patch.object(NASDataSource, "get_files", return_value=mock.MagicMock())
-@mock.patch("smbclient.walk")
-async def test_get_doc(mock_get_files, mock_walk):
+@mock.patch("smbclient.scandir", return_value=[mock_file(name="a1.md")])
+async def test_get_doc(dir_mock, nas_source):
     """Test get_doc method of NASDataSource Class
 
     Args:
-        mock_get_files (coroutine): The patch of get_files coroutine
-        mock_walk (patch): The patch of walk method of smbclient
+        dir_mock (patch): The patch of scandir method
     """
+    # Execute
+    documents = [document async for document, _ in nas_source.get_docs()]
+
+    # Assert
+    assert [document["title"] for document in documents] == ["a1.md"]
+    dir_mock.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_get_docs_lists_all_folders(nas_source):
+    """Test get_docs lists every folder of the drive once, without walking it"""
     # Setup
-    async with create_source(NASDataSource) as source:
+    nas_source.server_ip, nas_source.drive_path = "1.2.3.4", "a"
+    listings = {
+        "\\\\1.2.3.4/a": [
+            mock_file("d.txt", folder="\\\\1.2.3.4/a"),
+            mock_folder("b", folder="\\\\1.2.3.4/a"),
+        ],
+        "\\\\1.2.3.4/a/b": [mock_folder("e", folder="\\\\1.2.3.4/a/b")],
+        "\\\\1.2.3.4/a/b/e": [mock_file("c.txt", folder="\\\\1.2.3.4/a/b/e")],
+    }
+    with mock.patch.object(smbclient, "walk") as walk_mock:
+        with mock.patch.object(
+            smbclient,
+            "scandir",
+            side_effect=lambda path, **kwargs: listings[path],
+        ) as dir_mock:
+            # Execute
+            documents = {
+                document["path"]: lazy_download
+                async for document, lazy_download in nas_source.get_docs()
+            }
+
+    # Assert
+    walk_mock.assert_not_called()
+    assert sorted(call.args[0] for call in dir_mock.call_args_list) == [
+        "\\\\1.2.3.4/a",
+        "\\\\1.2.3.4/a/b",
+        "\\\\1.2.3.4/a/b/e",
+    ]
+    assert documents.keys() == {
+        "\\\\1.2.3.4/a/d.txt",
+        "\\\\1.2.3.4/a/b",
+        "\\\\1.2.3.4/a/b/e",
+        "\\\\1.2.3.4/a/b/e/c.txt",
+    }
+    assert documents["\\\\1.2.3.4/a/d.txt"] is not None
+    assert documents["\\\\1.2.3.4/a/b"] is None
+    assert documents["\\\\1.2.3.4/a/b/e"] is None
+    assert documents["\\\\1.2.3.4/a/b/e/c.txt"] is not None
+
+
+@pytest.mark.asyncio
+@mock.patch("smbclient.scandir", return_value=[mock_file(name="a1.md")])
+async def test_get_docs_when_listing_fails(dir_mock, nas_source):
+    """Test get_docs fails the sync on errors other than SMB ones
+
+    Args:
+        dir_mock (patch): The patch of scandir method
+    """
+    # Setup
+    queue_put = nas_source.queue.put
+
+    async def put(item):
+        # the documents can't be queued, as if the queue stayed full
+        if item != "FINISHED":
+            raise asyncio.QueueFull
+        await queue_put(item)
+
+    with mock.patch.object(nas_source.queue, "put", side_effect=put):
+        # Execute and Assert
+        with pytest.raises(asyncio.QueueFull):
+            [document async for document in nas_source.get_docs()]
+
+
+@pytest.mark.asyncio
+async def test_get_docs_cancels_listings_when_stopped_early(nas_source):
+    """Test get_docs stops listing the drive once its consumer stops"""
+    # Setup
+    nas_source.server_ip, nas_source.drive_path = "1.2.3.4", "a"
+
+    async def scandir(path):
+        if path == "\\\\1.2.3.4/a":
+            return [mock_folder("b", folder=path)]
+        # the listing of the sub folder never ends
+        await asyncio.Event().wait()
+
+    with mock.patch.object(NASDataSource, "_scandir", side_effect=scandir):
+        documents = nas_source.get_docs()
+        await anext(documents)
+        workers = list(nas_source.fetchers.tasks)
+
         # Execute
-        async for _, _ in source.get_docs():
-            # Assert
-            mock_get_files.assert_awaited()
+        await documents.aclose()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    # Assert
+    assert all(worker.cancelled() for worker in workers)
+
+
+@pytest.mark.asyncio
+async def test_get_docs_does_not_follow_links(nas_source):
+    """Test get_docs indexes a link to a folder without listing what it points to"""
+    # Setup
+    nas_source.server_ip, nas_source.drive_path = "1.2.3.4", "a"
+
+    def scandir(path, **kwargs):
+        # the link points back to its own parent, so every folder lists it again
+        return [
+            mock_folder(
+                "Application Data",
+                folder=path,
+                file_attributes=FileAttributes.FILE_ATTRIBUTE_DIRECTORY
+                | FileAttributes.FILE_ATTRIBUTE_REPARSE_POINT,
+            ),
+            mock_file("d.txt", folder=path),
+        ]
+
+    with mock.patch.object(smbclient, "scandir", side_effect=scandir) as dir_mock:
+        # Execute
+        documents = [document async for document, _ in nas_source.get_docs()]
+
+    # Assert
+    dir_mock.assert_called_once_with("\\\\1.2.3.4/a", connection_cache=ANY)
+    assert sorted(document["path"] for document in documents) == [
+        "\\\\1.2.3.4/a/Application Data",
+        "\\\\1.2.3.4/a/d.txt",
+    ]
 
 
 @pytest.mark.asyncio
 @mock.patch("smbclient.open_file")
-async def test_fetch_file_when_file_is_accessible(file_mock):
+async def test_fetch_file_when_file_is_accessible(file_mock, nas_source):
     """Tests the open_file method of smbclient when file can be accessed
 
     Args:
         file_mock (patch): The patch of open_file method
     """
     # Setup
+    path = "\\1.2.3.4/Users/file1.txt"
+
+    file_mock.return_value.read = mock.MagicMock(side_effect=[b"Mock....", b""])
+
+    # Execute
+    response = [chunk async for chunk in nas_source.fetch_file_content(path=path)]
+
+    # Assert
+    assert response == [b"Mock...."]
+    file_mock.return_value.read.assert_called_with(READ_CHUNK_SIZE)
+    file_mock.return_value.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_close_without_session():
     async with create_source(NASDataSource) as source:
-        path = "\\1.2.3.4/Users/file1.txt"
+        await source.close()
 
-        file_mock.return_value.__enter__.return_value.read = mock.MagicMock(
-            side_effect=side_effect_function
-        )
+    assert source.sessions == []
+
+
+def register_session(**kwargs):
+    """Fakes smbclient.register_session, which stores the connection in the cache"""
+    kwargs["connection_cache"]["1.2.3.4:445"] = mock.Mock()
 
+
+@pytest.mark.asyncio
+@mock.patch("smbclient.delete_session")
+@mock.patch("smbclient.register_session", side_effect=register_session)
+async def test_create_connection_registers_session_pool(session_mock, delete_mock):
+    """Tests create_connection registers one session per connection cache
+
+    Args:
+        session_mock (patch): The patch of register_session method
+        delete_mock (patch): The patch of delete_session method
+    """
+    # Setup
+    async with create_source(NASDataSource) as source:
         # Execute
-        response = source.fetch_file_content(path=path)
+        source.create_connection()
 
         # Assert
-        assert response.read() == b"Mock...."
+        assert session_mock.call_count == SESSION_POOL_SIZE
+        connection_caches = [
+            call.kwargs["connection_cache"] for call in session_mock.call_args_list
+        ]
+        assert len({id(cache) for cache in connection_caches}) == SESSION_POOL_SIZE
+        assert len(source.sessions) == SESSION_POOL_SIZE
+
+    assert delete_mock.call_count == SESSION_POOL_SIZE
+    assert source.sessions == []
 
 
 @pytest.mark.asyncio
-async def test_close_without_session():
+@mock.patch("smbclient.delete_session")
+@mock.patch("smbclient.register_session")
+async def test_close_when_session_pool_is_partly_registered(session_mock, delete_mock):
+    """Tests close deletes the sessions registered before create_connection failed
+
+    Args:
+        session_mock (patch): The patch of register_session method
+        delete_mock (patch): The patch of delete_session method
+    """
+
+    # Setup
+    def register_two_sessions(**kwargs):
+        if session_mock.call_count > 2:
+            raise ValueError("Too many connections")
+        register_session(**kwargs)
+
+    session_mock.side_effect = register_two_sessions
     async with create_source(NASDataSource) as source:
-        await source.close()
+        # Execute
+        with pytest.raises(ValueError):
+            source.create_connection()
+        connection_caches = source._connection_caches[:2]
+
+    # Assert
+    assert [
+        call.kwargs["connection_cache"] for call in delete_mock.call_args_list
+    ] == connection_caches
+    assert source.sessions == []
 
-    assert source.session is None
+
+@pytest.mark.asyncio
+async def test_acquire_session_picks_least_busy_session(nas_source):
+    async with nas_source._acquire_session() as first_cache:
+        async with nas_source._acquire_session() as second_cache:
+            assert first_cache is not second_cache
+    async with nas_source._acquire_session() as third_cache:
+        assert third_cache is first_cache
 
 
 @pytest.mark.parametrize(
@@ -476,109 +828,184 @@ async def test_close_without_session():
     ],
 )
 @pytest.mark.asyncio
-async def test_advanced_rules_validation(advanced_rules, expected_validation_result):
-    mock_data = [
-        ("\\1.2.3.4/a", ["d.txt"], ["b"]),
-        ("\\1.2.3.4/a/b", ["c.txt"], ["e"]),
-        ("\\1.2.3.4/a/b/e", [], []),
-    ]
-    async with create_source(NASDataSource) as source:
-        with mock.patch.object(smbclient, "register_session"):
-            with mock.patch.object(
-                smbclient, "walk", side_effect=[iter(mock_data), iter(mock_data)]
-            ):
-                validation_result = await NetworkDriveAdvancedRulesValidator(
-                    source
-                ).validate(advanced_rules)
+async def test_advanced_rules_validation(
+    advanced_rules, expected_validation_result, nas_source
+):
+    nas_source.server_ip, nas_source.drive_path = "1.2.3.4", "a"
+    with mock.patch.object(smbclient, "register_session"):
+        with mock.patch.object(
+            smbclient, "walk", side_effect=mock_walk(MOCK_WALK_DATA)
+        ):
+            validation_result = await NetworkDriveAdvancedRulesValidator(
+                nas_source
+            ).validate(advanced_rules)
+
+            assert validation_result == expected_validation_result
 
-                assert validation_result == expected_validation_result
+
+@pytest.mark.parametrize("advanced_rules", [[], {}])
+@pytest.mark.asyncio
+async def test_advanced_rules_validation_when_rules_are_empty(
+    advanced_rules, nas_source
+):
+    with mock.patch.object(smbclient, "register_session") as session_mock:
+        with mock.patch.object(smbclient, "walk") as walk_mock:
+            validation_result = await NetworkDriveAdvancedRulesValidator(
+                nas_source
+            ).validate(advanced_rules)
+
+    assert validation_result == SyncRuleValidationResult.valid_result(
+        SyncRuleValidationResult.ADVANCED_RULES
+    )
+    session_mock.assert_not_called()
+    walk_mock.assert_not_called()
 
 
 @pytest.mark.parametrize(
-    "filtering",
+    "filtering, expected_listed_folders",
     [
-        Filter(
-            {
-                ADVANCED_SNIPPET: {
-                    "value": [
-                        {"pattern": "training/python/async"},
-                        {"pattern": "training/**/examples"},
-                    ]
+        (
+            Filter(
+                {
+                    ADVANCED_SNIPPET: {
+                        "value": [
+                            {"pattern": "training/python/async"},
+                            {"pattern": "training/**/examples"},
+                        ]
+                    }
                 }
-            }
+            ),
+            [
+                "\\\\1.2.3.4/training",
+                "\\\\1.2.3.4/training/java",
+                "\\\\1.2.3.4/training/python",
+                "\\\\1.2.3.4/training/python/basics",
+                "\\\\1.2.3.4/training/python/basics/examples",
+                "\\\\1.2.3.4/training/python/async",
+            ],
+        ),
+        (
+            Filter(
+                {
+                    ADVANCED_SNIPPET: {
+                        "value": [
+                            {"pattern": "training/python/async"},
+                            {"pattern": "training/p*/**/examples"},
+                        ]
+                    }
+                }
+            ),
+            # java can't match p*, so it is never listed
+            [
+                "\\\\1.2.3.4/training",
+                "\\\\1.2.3.4/training/python",
+                "\\\\1.2.3.4/training/python/basics",
+                "\\\\1.2.3.4/training/python/basics/examples",
+                "\\\\1.2.3.4/training/python/async",
+            ],
         ),
     ],
 )
 @pytest.mark.asyncio
-async def test_get_docs_with_advanced_rules(filtering):
-    async with create_source(NASDataSource) as source:
-        response_list = []
-        mock_data = [
-            ("\\1.2.3.4/training", ["d.txt", "a.txt"], ["java", "python"]),
-            ("\\1.2.3.4/training/python", ["c.txt"], ["basics", "async"]),
-            ("\\1.2.3.4/training/python/async", ["coroutines.py"], []),
-            ("\\1.2.3.4/training/python/basics", [], ["examples"]),
-            ("\\1.2.3.4/training/python/basics/examples", ["lecture.py"], []),
-            (
-                "\\1.2.3.4/training/java",
-                ["hello.java", "inheritance.java", "collections.java"],
-                [],
-            ),
-        ]
+async def test_get_docs_with_advanced_rules(filtering, expected_listed_folders):
+    async with create_source(
+        NASDataSource, server_ip="1.2.3.4", drive_path="training"
+    ) as source:
+        listed_folders = []
+        listings = {
+            "\\\\1.2.3.4/training/python/async": [
+                mock_file("coroutines.py", folder="\\\\1.2.3.4/training/python/async")
+            ],
+            "\\\\1.2.3.4/training/python/basics/examples": [
+                mock_file(
+                    "lecture.py", folder="\\\\1.2.3.4/training/python/basics/examples"
+                )
+            ],
+        }
         with mock.patch.object(
-            smbclient, "walk", side_effect=[iter(mock_data), iter(mock_data)]
-        ):
+            smbclient,
+            "walk",
+            side_effect=mock_walk(TRAINING_WALK_DATA, listed_folders),
+        ) as walk_mock:
             with mock.patch.object(
-                NASDataSource,
-                "get_files",
-                side_effect=[
-                    AsyncIterator(
-                        [
-                            {
-                                "path": "\\1.2.3.4/training/python/basics/examples/lecture.py",
-                                "size": "2700",
-                                "_id": "1233",
-                                "created_at": "1111-11-11T11:11:11",
-                                "type": "file",
-                                "title": "lecture.py",
-                                "_timestamp": "1212-12-12T12:12:12",
-                            },
-                        ]
-                    ),
-                    AsyncIterator(
-                        [
-                            {
-                                "path": "\\1.2.3.4/training/python/async/coroutines.py",
-                                "size": "30000",
-                                "_id": "987",
-                                "created_at": "1111-11-11T11:11:11",
-                                "type": "file",
-                                "title": "coroutines.py",
-                                "_timestamp": "1212-12-12T12:12:12",
-                            },
-                        ]
-                    ),
-                ],
+                smbclient,
+                "scandir",
+                side_effect=lambda path, **kwargs: listings[path],
             ):
-                async for response in source.get_docs(filtering):
-                    response_list.append(response[0])
-        assert [
-            {
-                "path": "\\1.2.3.4/training/python/basics/examples/lecture.py",
-                "size": "2700",
-                "_id": "1233",
-                "created_at": "1111-11-11T11:11:11",
-                "type": "file",
-                "title": "lecture.py",
-                "_timestamp": "1212-12-12T12:12:12",
-            },
-            {
-                "path": "\\1.2.3.4/training/python/async/coroutines.py",
-                "size": "30000",
-                "_id": "987",
-                "created_at": "1111-11-11T11:11:11",
-                "type": "file",
-                "title": "coroutines.py",
-                "_timestamp": "1212-12-12T12:12:12",
-            },
-        ] == response_list
+                response_list = [
+                    document async for document, _ in source.get_docs(filtering)
+                ]
+        # training/python/async lies inside the root of the other rule, so the
+        # drive is walked once for both rules
+        walk_mock.assert_called_once_with(
+            top="\\\\1.2.3.4/training", connection_cache=ANY
+        )
+        # folders that can't match a pattern are never listed
+        assert listed_folders == expected_listed_folders
+        # folders are listed concurrently, so documents come in completion order
+        assert sorted(document["path"] for document in response_list) == [
+            "\\\\1.2.3.4/training/python/async/coroutines.py",
+            "\\\\1.2.3.4/training/python/basics/examples/lecture.py",
+        ]
+
+
+@pytest.mark.parametrize(
+    "pattern, expected_prefix, expected_tail",
+    [
+        ("training/python/async", "training/python/async", ""),
+        ("training/**/examples", "training", "**/examples"),
+        ("/training/python/*.py", "training/python", "*.py"),
+        ("*/examples", "", "*/examples"),
+    ],
+)
+def test_split_on_first_magic(pattern, expected_prefix, expected_tail):
+    assert _split_on_first_magic(pattern) == (expected_prefix, expected_tail)
+
+
+@pytest.mark.parametrize(
+    "path, pattern, expected_result",
+    [
+        ("training/python", "training/p*/**/examples", True),
+        ("training/java", "training/p*/**/examples", False),
+        ("training/python/basics/examples", "training/p*/**/examples", True),
+        ("training/python/async", "training/python/async", True),
+        ("training/python/async/old", "training/python/async", False),
+    ],
+)
+def test_can_match_below(path, pattern, expected_result):
+    assert _can_match_below(path, pattern) is expected_result
+
+
+@pytest.mark.asyncio
+async def test_find_matching_paths_walks_shared_root_once(nas_source):
+    nas_source.server_ip, nas_source.drive_path = "1.2.3.4", "a"
+    advanced_rules = [{"pattern": "**/b"}, {"pattern": "**/e"}]
+    with mock.patch.object(
+        smbclient, "walk", side_effect=mock_walk(MOCK_WALK_DATA)
+    ) as walk_mock:
+        matched_paths, invalid_rules = await nas_source.find_matching_paths(
+            advanced_rules
+        )
+        # a walk pruned for both rules serves either of them
+        await nas_source.find_matching_paths(advanced_rules[:1])
+
+    walk_mock.assert_called_once_with(top="\\\\1.2.3.4/a", connection_cache=ANY)
+    assert matched_paths == {"\\\\1.2.3.4/a/b", "\\\\1.2.3.4/a/b/e"}
+    assert invalid_rules == []
+
+
+@pytest.mark.asyncio
+async def test_find_matching_paths_reuses_compiled_patterns(nas_source):
+    nas_source.server_ip, nas_source.drive_path = "1.2.3.4", "a"
+    advanced_rules = [{"pattern": "a/b/*"}, {"pattern": "a/*"}]
+    with mock.patch.object(smbclient, "walk", side_effect=mock_walk(MOCK_WALK_DATA)):
+        await nas_source.find_matching_paths(advanced_rules)
+        hits = _compile_pattern.cache_info().hits
+
+        matched_paths, invalid_rules = await nas_source.find_matching_paths(
+            advanced_rules
+        )
+
+    assert _compile_pattern.cache_info().hits == hits + len(advanced_rules)
+    assert matched_paths == {"\\\\1.2.3.4/a/b", "\\\\1.2.3.4/a/b/e"}
+    assert invalid_rules == []